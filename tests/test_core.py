@@ -45,13 +45,64 @@ class CoreTests(unittest.TestCase):
         entries = core.ldif_to_entries(VALID_LDIF)
         self.assertEqual(VALID_ENTRIES, entries)
 
+    def test_ldif_to_entries_folded_value(self):
+        ldif = (
+            b"dn: ou=people,dc=example,dc=org\n"
+            b"description: A long description, which ldapsearch wraps at\n"
+            b"  76 columns\n"
+        )
+        entries = core.ldif_to_entries(ldif)
+        self.assertEqual(
+            [b'A long description, which ldapsearch wraps at 76 columns'],
+            entries['ou=people,dc=example,dc=org']['description'],
+        )
+
+    def test_ldif_to_entries_folded_base64(self):
+        ldif = (
+            b"dn: ou=people,dc=example,dc=org\n"
+            b"description:: Y2Fmw6kgY2Fm\n"
+            b" w6kgY2Fmw6k=\n"
+        )
+        entries = core.ldif_to_entries(ldif)
+        self.assertEqual(
+            ['caf\xe9 caf\xe9 caf\xe9'.encode('utf-8')],
+            entries['ou=people,dc=example,dc=org']['description'],
+        )
+
+    def test_ldif_to_entries_crlf(self):
+        ldif = VALID_LDIF.replace(b'\n', b'\r\n').replace(
+            b'ou: admins\r\n',
+            b'ou: adm\r\n ins\r\n',
+        )
+        entries = core.ldif_to_entries(ldif)
+        self.assertEqual(VALID_ENTRIES, entries)
+
+    def test_ldif_to_entries_header_without_blank_line(self):
+        ldif = VALID_LDIF.replace(b'version: 1\n\n', b'version: 1\n')
+        entries = core.ldif_to_entries(ldif)
+        self.assertEqual(VALID_ENTRIES, entries)
+
+    def test_ldif_to_entries_no_space_after_colon(self):
+        entries = core.ldif_to_entries(b"dn:ou=people,dc=example,dc=org\nou:people\n")
+        self.assertEqual({'ou=people,dc=example,dc=org': {'ou': [b'people']}}, entries)
+
+    def test_ldif_to_entries_invalid_lines(self):
+        for line in [b'foo bar: x', b'description:< file:///etc/passwd', b'no separator']:
+            with self.subTest(line=line):
+                with self.assertRaises(ValueError):
+                    core.ldif_to_entries(b'dn: ou=people,dc=example,dc=org\n' + line + b'\n')
+
     def test_entries_to_ldif(self):
         ldif = '\n'.join(core.entries_to_ldif(VALID_ENTRIES))
         self.assertEqual(VALID_LDIF.decode('ascii'), ldif)
 
+    def test_entries_to_ldif_bytes(self):
+        ldif = b'\n'.join(core.entries_to_ldif_bytes(VALID_ENTRIES))
+        self.assertEqual(VALID_LDIF, ldif)
+
     def test_loop_from_ldif(self):
-        ldif = '\n'.join(core.entries_to_ldif(core.ldif_to_entries(VALID_LDIF)))
-        self.assertEqual(VALID_LDIF, ldif.encode('ascii'))
+        ldif = b'\n'.join(core.entries_to_ldif_bytes(core.ldif_to_entries(VALID_LDIF)))
+        self.assertEqual(VALID_LDIF, ldif)
 
     def test_loop_from_entries(self):
         entries = core.ldif_to_entries(
@@ -1,105 +1,236 @@
 # -*- coding: utf-8 -*-
 # This software is distributed under the two-clause BSD license.
 
+import asyncio
 import os
+import select
 import socket
+import sys
 import time
 import unittest
 
-import psutil
-
 import volatildap
 
+# Sample data, as provided to a server
+TEST_DATA = {
+    'ou=test': {
+        'objectClass': ['organizationalUnit'],
+        'ou': ['test'],
+    },
+}
+PEOPLE_DATA = {
+    'ou=people': {
+        'objectClass': ['organizationalUnit'],
+        'ou': ['people'],
+    },
+}
+
+# The same entries, as returned by a server
+TEST_ENTRY = {
+    'objectClass': [b'organizationalUnit'],
+    'ou': [b'test'],
+}
+PEOPLE_ENTRY = {
+    'objectClass': [b'organizationalUnit'],
+    'ou': [b'people'],
+}
+
+
+def find_available_ports(count):
+    """Find a batch of available ports.
+
+    Simple trick: open sockets to localhost, see what ports were allocated.
+    All sockets are kept open until the last one is bound, which guarantees
+    that the ports are distinct; SO_REUSEADDR is left unset so that ports
+    from a closed probe aren't handed to a concurrent test process.
 
-def find_available_port():
-    """Find an available port.
+    Could fail in highly concurrent setups, though.
+    """
+    sockets = []
+    try:
+        for _i in range(count):
+            s = socket.socket()
+            sockets.append(s)
+            s.bind(('localhost', 0))
+        return [s.getsockname()[1] for s in sockets]
+    finally:
+        for s in sockets:
+            s.close()
 
-    Simple trick: open a socket to localhost, see what port was allocated.
 
-    Could fail in highly concurrent setups, though.
+def _wait_pid(pid, timeout):
+    """Wait for a process to exit, without polling.
+
+    Relies on pidfd_open() on Linux, and on kqueue() on BSD / macOS.
+
+    Returns:
+        bool: whether the process exited before the timeout.
+
+    Raises:
+        OSError: when the platform doesn't support waiting on an arbitrary pid.
     """
-    s = socket.socket()
-    s.bind(('localhost', 0))
-    _address, port = s.getsockname()
-    s.close()
-    return port
+    if hasattr(os, 'pidfd_open'):
+        try:
+            fd = os.pidfd_open(pid, 0)
+        except ProcessLookupError:
+            # Already gone
+            return True
+        try:
+            poller = select.poll()
+            poller.register(fd, select.POLLIN)
+            return bool(poller.poll(timeout * 1000))
+        finally:
+            os.close(fd)
+
+    elif hasattr(select, 'kqueue'):
+        kq = select.kqueue()
+        try:
+            event = select.kevent(
+                pid,
+                filter=select.KQ_FILTER_PROC,
+                flags=select.KQ_EV_ADD | select.KQ_EV_ONESHOT,
+                fflags=select.KQ_NOTE_EXIT,
+            )
+            try:
+                return bool(kq.control([event], 1, timeout))
+            except ProcessLookupError:
+                return True
+        finally:
+            kq.close()
+
+    raise OSError("Unable to wait on pid %d on this platform" % pid)
+
+
+def _ppid(pid):
+    """Find the parent of a process; None if it has died or is out of reach."""
+    if sys.platform.startswith('linux'):
+        try:
+            with open('/proc/%d/status' % pid) as f:
+                for line in f:
+                    if line.startswith('PPid:'):
+                        return int(line.split()[1])
+        except (FileNotFoundError, ProcessLookupError):
+            pass
+        return None
+
+    import psutil
+
+    try:
+        return psutil.Process(pid).ppid()
+    except (psutil.NoSuchProcess, psutil.AccessDenied):
+        return None
 
 
 class LdapServerTestCase(unittest.TestCase):
+    # When set, a server is started with those arguments for the whole class,
+    # and reset before each test.
+    shared_server_kwargs = None
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.shared_server = None
+        cls.shared_context = None
+        if cls.shared_server_kwargs is not None:
+            cls.shared_server = volatildap.LdapServer(**cls.shared_server_kwargs)
+            cls.shared_server.start()
+            cls.shared_context = cls._server_context(cls.shared_server)
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.shared_server is not None:
+            cls.shared_server.stop()
+            cls.assertServerStopped(cls.shared_context)
+        super().tearDownClass()
+
+    @staticmethod
+    def _server_context(server):
+        return {
+            'dirname': server._tempdir.name,
+            'pid': server._process.pid,
+        }
+
     def setUp(self):
         super().setUp()
-        self.server = None
+        self.server = self.shared_server
         self.context = None
+        if self.server is not None:
+            self.server.reset()
 
     def _launch_server(self, **kwargs):
+        """Launch a server dedicated to the current test."""
         self.server = volatildap.LdapServer(**kwargs)
         self.server.start()
-        self.context = {
-            'dirname': self.server._tempdir.name,
-            'pid': self.server._process.pid,
-        }
+        self.context = self._server_context(self.server)
 
     def tearDown(self):
-        if self.server is not None:
+        if self.context is not None:
             self.server.stop()
             self.assertServerStopped(self.context)
         super().tearDown()
 
-    def assertServerStopped(self, context, max_delay=5):
-        now = time.time()
+    @classmethod
+    def assertServerStopped(cls, context, max_delay=5):
+        """Check that a server has shut down; usable from tearDownClass()."""
         # Allow some time for proper shutdown
-        while time.time() < now + max_delay and os.path.exists(context['dirname']):
-            time.sleep(0.2)
-
-        self.assertFalse(os.path.exists(context['dirname']))
+        try:
+            exited = _wait_pid(context['pid'], max_delay)
+        except OSError:
+            exited = False
+
+        if not exited:
+            # A single directory listing of the parent folder covers all
+            # the servers being cleaned up concurrently.
+            parent, basename = os.path.split(context['dirname'])
+            delay = 0.001
+            deadline = time.time() + max_delay
+            while time.time() < deadline:
+                with os.scandir(parent) as entries:
+                    if not any(entry.name == basename for entry in entries):
+                        break
+                time.sleep(delay)
+                delay = min(delay * 2, 0.2)
+
+        if os.path.exists(context['dirname']):
+            raise AssertionError("Server directory %s still exists" % context['dirname'])
 
         # Check that the process is no longer running.
         # We cannot rely solely on "the pid is no longer running", as it may
         # have been reused by the operating system.
         # If a process by that pid still exists, we'll check that we aren't its parent.
-        try:
-            stats = psutil.Process(context['pid'])
-            ppid = stats.ppid()
-        except (psutil.NoSuchProcess, psutil.AccessDenied):
+        ppid = _ppid(context['pid'])
+        if ppid is None:
             # Process has died / is not in our context: all is fine.
             return
 
-        self.assertNotEqual(ppid, os.getpid())
+        if ppid == os.getpid():
+            raise AssertionError("Server process %d is still running" % context['pid'])
 
 
 class ReadWriteTests(LdapServerTestCase):
-    data = {
-        'ou=test': {
-            'objectClass': ['organizationalUnit'],
-            'ou': ['test'],
-        },
-    }
-
-    def test_initial_data(self):
-        self._launch_server(initial_data=self.data)
-        entry = self.server.get('ou=test,dc=example,dc=org')
-        self.assertEqual({
-            'objectClass': [b'organizationalUnit'],
-            'ou': [b'test'],
-        }, entry)
+    shared_server_kwargs = {}
 
     def test_post_start_add(self):
-        self._launch_server()
-        self.server.add(self.data)
+        self.server.add(TEST_DATA)
         entry = self.server.get('ou=test,dc=example,dc=org')
-        self.assertEqual({
-            'objectClass': [b'organizationalUnit'],
-            'ou': [b'test'],
-        }, entry)
+        self.assertEqual(TEST_ENTRY, entry)
+
+    @unittest.skipIf(volatildap.server.ldap3 is None, "ldap3 is not installed")
+    def test_ldap3_connection(self):
+        """With ldap3 available, operations go through an in-process connection."""
+        self.assertIsNotNone(self.server._conn)
 
     def test_get_missing_entry(self):
-        self._launch_server()
         with self.assertRaises(KeyError):
             self.server.get('ou=test,dc=example,dc=org')
 
+
+class RestartTests(LdapServerTestCase):
+    """Tests restarting their own server."""
+
     def test_clear_data(self):
         self._launch_server()
-        self.server.add(self.data)
+        self.server.add(TEST_DATA)
         self.assertIsNotNone(self.server.get('ou=test,dc=example,dc=org'))
 
         self.server.start()  # Actually a restart
@@ -112,16 +243,18 @@ class ReadWriteTests(LdapServerTestCase):
         self.assertIsNotNone(self.server.get('dc=example,dc=org'))
 
 
+class InitialDataTests(LdapServerTestCase):
+    shared_server_kwargs = {'initial_data': TEST_DATA}
+
+    def test_initial_data(self):
+        entry = self.server.get('ou=test,dc=example,dc=org')
+        self.assertEqual(TEST_ENTRY, entry)
+
+
 class ResetTests(LdapServerTestCase):
-    data = {
-        'ou=test': {
-            'objectClass': ['organizationalUnit'],
-            'ou': ['test'],
-        },
-    }
+    shared_server_kwargs = {'initial_data': TEST_DATA}
 
     def test_cleanup(self):
-        self._launch_server(initial_data=self.data)
         extra = {
             'ou=subarea,ou=test': {
                 'objectClass': ['organizationalUnit'],
@@ -137,20 +270,77 @@ class ResetTests(LdapServerTestCase):
 
         # Initial data should still be here
         entry = self.server.get('ou=test,dc=example,dc=org')
-        self.assertEqual({
-            'objectClass': [b'organizationalUnit'],
-            'ou': [b'test'],
-        }, entry)
+        self.assertEqual(TEST_ENTRY, entry)
+
+    def test_cleanup_nested(self):
+        """Nested entries are removed deepest first, whichever client is used."""
+        extra = {
+            'ou=subarea,ou=test': {
+                'objectClass': ['organizationalUnit'],
+            },
+            'ou=deeper,ou=subarea,ou=test': {
+                'objectClass': ['organizationalUnit'],
+            },
+            'ou=other,ou=subarea,ou=test': {
+                'objectClass': ['organizationalUnit'],
+            },
+        }
+        self.server.add(extra)
+        self.server.reset()
+
+        for dn in extra:
+            with self.assertRaises(KeyError):
+                self.server.get(dn)
+        entry = self.server.get('ou=test,dc=example,dc=org')
+        self.assertEqual(TEST_ENTRY, entry)
 
 
 class TLSTests(LdapServerTestCase):
+    shared_server_kwargs = {'tls_config': volatildap.LOCALHOST_TLS_CONFIG}
+
     def test_connection(self):
-        self._launch_server(tls_config=volatildap.LOCALHOST_TLS_CONFIG)
         self.assertEqual(self.server.uri[:8], 'ldaps://')
         entry = self.server.get('dc=example,dc=org')
         self.assertEqual([b'example'], entry['dc'])
 
 
+class LdapiTests(LdapServerTestCase):
+    shared_server_kwargs = {'use_ldapi': True}
+
+    def test_connection(self):
+        self.assertEqual(self.server.uri[:8], 'ldapi://')
+        self.assertIsNone(self.server.port)
+        entry = self.server.get('dc=example,dc=org')
+        self.assertEqual([b'example'], entry['dc'])
+
+    def test_add(self):
+        self.server.add(TEST_DATA)
+        entry = self.server.get('ou=test,dc=example,dc=org')
+        self.assertEqual(TEST_ENTRY, entry)
+
+
+class AsyncStartTests(unittest.TestCase):
+    """Starts its own servers: no need for LdapServerTestCase's setup."""
+
+    def test_astart(self):
+        servers = [volatildap.LdapServer(), volatildap.LdapServer()]
+
+        async def start_all():
+            await asyncio.gather(*(server.astart() for server in servers))
+
+        asyncio.run(start_all())
+        contexts = [LdapServerTestCase._server_context(server) for server in servers]
+        try:
+            for server in servers:
+                entry = server.get('dc=example,dc=org')
+                self.assertEqual([b'example'], entry['dc'])
+        finally:
+            for server in servers:
+                server.stop()
+        for context in contexts:
+            LdapServerTestCase.assertServerStopped(context)
+
+
 class AutoCleanupTests(LdapServerTestCase):
 
     def test_stop(self):
@@ -159,26 +349,30 @@ class AutoCleanupTests(LdapServerTestCase):
         self._launch_server()
 
 
-class ControlTests(LdapServerTestCase):
-    def setUp(self):
-        super().setUp()
-        self.proxy = None
+class ControlTestCase(LdapServerTestCase):
+    """Tests against a shared server, through its control server."""
 
-    def tearDown(self):
-        if self.proxy:
-            self.proxy.stop()
-        super().tearDown()
+    # Arguments for the shared server, in addition to its control address.
+    server_kwargs = {}
 
-    def _launch_server(self, **kwargs):
-        control_port = find_available_port()
-        super()._launch_server(
+    @classmethod
+    def setUpClass(cls):
+        control_port, = find_available_ports(1)
+        cls.shared_server_kwargs = dict(
+            cls.server_kwargs,
             control_address=('localhost', control_port),
-            **kwargs,
         )
-        self.proxy = volatildap.ProxyServer('http://localhost:%d/' % control_port)
+        super().setUpClass()
+        cls.proxy = volatildap.ProxyServer('http://localhost:%d/' % control_port)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.proxy.stop()
+        super().tearDownClass()
 
+
+class ControlTests(ControlTestCase):
     def test_launch_control(self):
-        self._launch_server()
         self.assertEqual(
             self.server.uri,
             self.proxy.uri,
@@ -187,57 +381,51 @@ class ControlTests(LdapServerTestCase):
         self.assertEqual(self.server.rootdn, self.proxy.rootdn)
         self.assertEqual(self.server.rootpw, self.proxy.rootpw)
 
-    def test_tls(self):
-        """The server CA should be available through the proxy."""
-        self._launch_server(tls_config=volatildap.LOCALHOST_TLS_CONFIG)
-        self.assertEqual(self.proxy.uri[:8], 'ldaps://')
-        self.assertIsNotNone(self.proxy.tls_config)
-        self.assertIsNotNone(self.proxy.tls_config.root)
-
-    def test_get(self):
-        initial = {'ou=people': {
-            'objectClass': ['organizationalUnit'],
-            'ou': ['people'],
-        }}
-        self._launch_server(
-            initial_data=initial,
-        )
-
-        entry = self.proxy.get('ou=people')
-        self.assertEqual(
-            {
-                'objectClass': [b'organizationalUnit'],
-                'ou': [b'people'],
-            },
-            entry,
-        )
-
     def test_add(self):
-        self._launch_server()
-        data = {'ou=people': {
-            'objectClass': ['organizationalUnit'],
-            'ou': ['people'],
-        }}
-        self.proxy.add(data)
+        """Entries are exchanged as LDIF, whether msgpack is available or not."""
+        proxy = volatildap.ProxyServer(self.proxy.base_url)
+        self.addCleanup(proxy._session.close)
+        proxy._use_msgpack = False
+        proxy.add(PEOPLE_DATA)
+        entry = proxy.get('ou=people')
+        self.assertEqual(PEOPLE_ENTRY, entry)
+
+    @unittest.skipIf(volatildap.control.msgpack is None, "msgpack is not installed")
+    def test_add_msgpack(self):
+        # The control server runs in this process: it supports msgpack as well.
+        self.assertTrue(self.proxy._use_msgpack)
+        self.proxy.add(PEOPLE_DATA)
         entry = self.proxy.get('ou=people')
-        self.assertEqual(
-            {
-                'objectClass': [b'organizationalUnit'],
-                'ou': [b'people'],
-            },
-            entry,
-        )
+        self.assertEqual(PEOPLE_ENTRY, entry)
+
+    def test_wait_timeout(self):
+        """A running server makes wait() time out through the control server."""
+        with self.assertRaises(volatildap.core.TimeoutExpired):
+            self.proxy.wait(timeout=0.1)
 
     def test_reset(self):
-        self._launch_server()
-        data = {'ou=people': {
-            'objectClass': ['organizationalUnit'],
-            'ou': ['people'],
-        }}
-        self.proxy.add(data)
+        self.proxy.add(PEOPLE_DATA)
         # Ensure the data is visible
         self.proxy.get('ou=people')
         self.proxy.reset()
 
         with self.assertRaises(KeyError):
             self.proxy.get('ou=people')
+
+
+class ControlTLSTests(ControlTestCase):
+    server_kwargs = {'tls_config': volatildap.LOCALHOST_TLS_CONFIG}
+
+    def test_tls(self):
+        """The server CA should be available through the proxy."""
+        self.assertEqual(self.proxy.uri[:8], 'ldaps://')
+        self.assertIsNotNone(self.proxy.tls_config)
+        self.assertIsNotNone(self.proxy.tls_config.root)
+
+
+class ControlInitialDataTests(ControlTestCase):
+    server_kwargs = {'initial_data': PEOPLE_DATA}
+
+    def test_get(self):
+        entry = self.proxy.get('ou=people')
+        self.assertEqual(PEOPLE_ENTRY, entry)
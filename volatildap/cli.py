@@ -1,38 +1,79 @@
 # This software is distributed under the two-clause BSD license.
 
-import argparse
 import logging
+import mmap
+import os
 import sys
+import types
+from urllib.parse import urlsplit
 
 from . import LOCALHOST_TLS_CONFIG
 from . import core
 from . import server
 
+# Below this size, mapping a file costs more than reading it.
+MMAP_MIN_SIZE = 8 * 1024
+
+
+def load_ldif(f):
+    """Load entries from a LDIF file object.
+
+    Large regular files are mapped in memory instead of being read.
+    """
+    try:
+        size = os.fstat(f.fileno()).st_size
+    except (OSError, ValueError):
+        size = 0
+
+    if size < MMAP_MIN_SIZE:
+        # Small file, or a pipe / stdin.
+        return core.ldif_to_entries(f.read())
+
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        return core.ldif_to_entries(data)
+
+
+DEFAULTS = dict(
+    port='',
+    host='localhost',
+    suffix=server.DEFAULT_SUFFIX,
+    rootdn=server.DEFAULT_ROOTDN,
+    rootpw='',
+    debug=server.DEFAULT_SLAPD_DEBUG,
+    control=None,
+    initial=None,
+    schemas=server.DEFAULT_SCHEMAS,
+    tls=False,
+)
+
+
+def build_parser():
+    import argparse
 
-def launch(argv):
     parser = argparse.ArgumentParser()
+    parser.set_defaults(**DEFAULTS)
     parser.add_argument(
-        '--port', default='',
+        '--port',
         help="Port to listen on; empty for a dynamic port",
     )
     parser.add_argument(
-        '--host', default='localhost',
+        '--host',
         help="Host to listen on; defaults to localhost",
     )
     parser.add_argument(
-        '--suffix', default=server.DEFAULT_SUFFIX,
+        '--suffix',
         help="LDAP suffix",
     )
     parser.add_argument(
-        '--rootdn', default=server.DEFAULT_ROOTDN,
+        '--rootdn',
         help="Distinguished Name of LDAP admin user",
     )
     parser.add_argument(
-        '--rootpw', default='',
+        '--rootpw',
         help="Password of LDAP admin user",
     )
     parser.add_argument(
-        '--debug', default=server.DEFAULT_SLAPD_DEBUG, type=int,
+        '--debug', type=int,
         help="slapd debug level",
     )
     parser.add_argument(
@@ -44,18 +85,85 @@ def launch(argv):
         help="Load initial objects from the provided LDIF file",
     )
     parser.add_argument(
-        '--schemas', nargs='*', default=server.DEFAULT_SCHEMAS,
+        '--schemas', nargs='*',
         help="Schemas to load (multi-valued)",
     )
     parser.add_argument(
         '--tls', action='store_true',
         help="Enable TLS, using a built-in stack",
     )
+    return parser
+
 
-    args = parser.parse_args(argv)
+# Options taking a single value, for scan_args()
+_VALUE_OPTIONS = {
+    '--port', '--host', '--suffix', '--rootdn', '--rootpw', '--debug', '--control', '--initial',
+}
+
+
+def scan_args(argv):
+    """Parse the usual forms of the command line, without argparse.
+
+    Raises:
+        ValueError: the command line is unusual (help, abbreviated options,
+            invalid values, ...) and should be handled by argparse.
+    """
+    values = dict(DEFAULTS)
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        i += 1
+        name, sep, value = arg.partition('=')
+        if arg == '--tls':
+            values['tls'] = True
+        elif name == '--schemas':
+            if sep:
+                values['schemas'] = [value]
+                continue
+            schemas = []
+            while i < len(argv) and not argv[i].startswith('-'):
+                schemas.append(argv[i])
+                i += 1
+            values['schemas'] = schemas
+        elif name in _VALUE_OPTIONS:
+            if not sep:
+                if i == len(argv) or argv[i].startswith('-'):
+                    raise ValueError("Missing value for %s" % name)
+                value = argv[i]
+                i += 1
+            values[name[2:]] = value
+        else:
+            raise ValueError("Unexpected argument %r" % arg)
+
+    values['debug'] = int(values['debug'])
+    if values['initial'] == '-':
+        # As argparse.FileType
+        values['initial'] = sys.stdin.buffer
+    elif values['initial'] is not None:
+        try:
+            values['initial'] = open(values['initial'], 'rb')
+        except OSError as e:
+            # Let argparse report it as a usage error.
+            raise ValueError("Unable to open %s" % values['initial']) from e
+    return types.SimpleNamespace(**values)
+
+
+def parse_args(argv):
+    """Parse the command line.
+
+    argparse is only loaded when the command line requires it.
+    """
+    try:
+        return scan_args(argv)
+    except ValueError:
+        return build_parser().parse_args(argv)
+
+
+def launch(argv):
+    args = parse_args(argv)
     if args.initial:
-        lines = b''.join(args.initial)
-        initial = core.ldif_to_entries(lines)
+        with args.initial:
+            initial = load_ldif(args.initial)
     else:
         initial = {}
     if args.tls:
@@ -64,8 +172,11 @@ def launch(argv):
         tls_config = None
 
     if args.control:
-        address, port = args.control.rsplit(':', 1)
-        control_address = (address, int(port))
+        # Supports 'host:port', ':port' and '[ipv6]:port'.
+        control = urlsplit('//' + args.control)
+        if control.port is None:
+            raise ValueError("Missing port in control address %r" % args.control)
+        control_address = (control.hostname or '', control.port)
     else:
         control_address = ()
 
@@ -2,32 +2,49 @@
 
 import http.server
 import json
-import subprocess
-import sys
+import socket
 import threading
 import time
+from urllib.parse import parse_qs
 from urllib.parse import urljoin
+from urllib.parse import urlsplit
 
 import requests
+import requests.adapters
 
 from . import core
 
-if sys.version_info < (3, 7):
-    HTTPServer = http.server.HTTPServer
-else:
-    HTTPServer = http.server.ThreadingHTTPServer
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 
-class ControlServer(HTTPServer):
+# How long a single control/wait call may block, in seconds
+DEFAULT_WAIT_TIMEOUT = 25
+
+# Entries can be exchanged as msgpack-encoded {dn => {attribute => [values]}},
+# skipping LDIF serialization, when the server advertises it in its
+# configuration; LDIF is used otherwise.
+MSGPACK_CONTENT_TYPE = 'application/msgpack'
+
+# Streamed responses are sent in chunks of (at least) this size.
+CHUNK_SIZE = 64 * 1024
+
+
+class ControlServer(http.server.ThreadingHTTPServer):
     """The HTTP control server.
 
     Launched in a background thread; keeps a reference to the actual
     server.LdapServer instance.
     """
     def __init__(self, server_address, ldap_server):
+        if ':' in server_address[0]:
+            self.address_family = socket.AF_INET6
         super().__init__(server_address, RequestHandler)
         self.ldap_server = ldap_server
         self._thread = None
+        self._config_body = None
 
     def start(self):
         if self._thread is not None:
@@ -40,6 +57,29 @@ class ControlServer(HTTPServer):
         )
         self._thread.start()
 
+    @property
+    def config_body(self):
+        """The JSON-encoded server configuration.
+
+        Computed once: it doesn't change over the lifetime of the server.
+        """
+        if self._config_body is None:
+            ldap = self.ldap_server
+            tls_config = ldap.tls_config
+            data = dict(
+                suffix=ldap.suffix,
+                rootdn=ldap.rootdn,
+                rootpw=ldap.rootpw,
+                port=ldap.port,
+                host=ldap.host,
+                uri=ldap.uri,
+                # Whether entries may be exchanged as msgpack
+                msgpack=msgpack is not None,
+                tls_root=tls_config.root if tls_config else None
+            )
+            self._config_body = json.dumps(data).encode('utf-8')
+        return self._config_body
+
     def stop(self):
         if self._thread is None:
             return
@@ -50,6 +90,9 @@ class ControlServer(HTTPServer):
 
 
 class RequestHandler(http.server.BaseHTTPRequestHandler):
+    # Keep connections alive: every response must provide its Content-Length.
+    protocol_version = 'HTTP/1.1'
+
     @property
     def ldap(self):
         return self.server.ldap_server
@@ -57,71 +100,133 @@ class RequestHandler(http.server.BaseHTTPRequestHandler):
     def _send_empty(self, status_code, message=None):
         """Send an empty HTTP response, with a specific status code."""
         self.send_response(status_code, message=message)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _discard_body(self):
+        """Consume an unused request body.
+
+        Otherwise, it would be parsed as the next request on a kept-alive connection.
+        """
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _send_chunked(self, content_type, lines):
+        """Stream text lines, joined with '\n', as a chunked HTTP response."""
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
         self.end_headers()
 
+        buf = bytearray()
+        for i, line in enumerate(lines):
+            if i:
+                buf += b'\n'
+            buf += line.encode('utf-8')
+            if len(buf) >= CHUNK_SIZE:
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(buf), buf))
+                buf.clear()
+        if buf:
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(buf), buf))
+        self.wfile.write(b'0\r\n\r\n')
+
+    # Path (without surrounding slashes) => handler method name
+    POST_ROUTES = {
+        'control/reset': 'post_reset',
+        'control/stop': 'post_stop',
+        'control/start': 'post_start',
+        'entry': 'post_entries',
+    }
+    GET_ROUTES = {
+        'config': 'get_config',
+        'control/wait': 'get_wait',
+    }
+
     def do_POST(self):
-        if self.path.strip('/') == 'control/reset':
-            self.ldap.reset()
-            self._send_empty(204)
-        elif self.path.strip('/') == 'control/stop':
-            self.ldap.stop()
-            self._send_empty(204)
-        elif self.path.strip('/') == 'control/start':
-            self.ldap.start()
-            self._send_empty(204)
-        elif self.path.strip('/') == 'entry':
-            self.post_entries()
-        else:
+        handler = self.POST_ROUTES.get(self.path.strip('/'))
+        if handler is None:
+            self._discard_body()
             self._send_empty(404)
+        else:
+            getattr(self, handler)()
 
     def do_GET(self):
         if self.path.startswith('/entry/'):
             self.get_entry(self.path[len('/entry/'):])
-        elif self.path.strip('/') == 'config':
-            self.get_config()
-        elif self.path.strip('/') == 'control/wait':
-            self.get_wait()
-        else:
+            return
+
+        url = urlsplit(self.path)
+        handler = self.GET_ROUTES.get(url.path.strip('/'))
+        if handler is None:
             self._send_empty(404)
+        else:
+            getattr(self, handler)(parse_qs(url.query))
+
+    def post_reset(self):
+        self._discard_body()
+        self.ldap.reset()
+        self._send_empty(204)
+
+    def post_stop(self):
+        self._discard_body()
+        self.ldap.stop()
+        self._send_empty(204)
+
+    def post_start(self):
+        self._discard_body()
+        self.ldap.start()
+        self._send_empty(204)
 
     def post_entries(self):
         length = int(self.headers['Content-Length'])
         data = self.rfile.read(length)
-        self.ldap.add_ldif(data)
+        if self.headers.get('Content-Type') == MSGPACK_CONTENT_TYPE:
+            if msgpack is None:
+                self._send_empty(415, "msgpack is not available")
+                return
+            self.ldap.add(msgpack.unpackb(data, raw=False))
+        else:
+            self.ldap.add_ldif(data)
         self._send_empty(201)
 
-    def get_config(self):
-        tls_config = self.ldap.tls_config
-        data = dict(
-            suffix=self.ldap.suffix,
-            rootdn=self.ldap.rootdn,
-            rootpw=self.ldap.rootpw,
-            port=self.ldap.port,
-            host=self.ldap.host,
-            tls_root=tls_config.root if tls_config else None
-        )
+    def get_config(self, query):
+        body = self.server.config_body
         self.send_response(200)
         self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
         self.end_headers()
-        self.wfile.write(json.dumps(data).encode('utf-8'))
+        self.wfile.write(body)
 
     def get_entry(self, dn):
+        as_msgpack = msgpack is not None and MSGPACK_CONTENT_TYPE in self.headers.get('Accept', '')
         try:
-            entry = self.ldap.get_ldif(dn)
+            if as_msgpack:
+                body = msgpack.packb(self.ldap.get(dn), use_bin_type=True)
+            else:
+                lines = self.ldap.iter_ldif(dn)
         except KeyError as e:
             self._send_empty(404, str(e))
         except RuntimeError as e:
             self._send_empty(500, str(e))
         else:
-            self.send_response(200)
-            self.send_header("Content-Type", "text/ldif")
-            self.end_headers()
-            self.wfile.write(entry.encode('utf-8'))
+            if as_msgpack:
+                self.send_response(200)
+                self.send_header("Content-Type", MSGPACK_CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            else:
+                self._send_chunked("text/ldif", lines)
 
-    def get_wait(self):
+    def get_wait(self, query):
         try:
-            self.ldap.wait(5)
-        except subprocess.TimeoutExpired as e:
+            timeout = float(query.get('timeout', [DEFAULT_WAIT_TIMEOUT])[0])
+        except ValueError:
+            self._send_empty(400, "Invalid timeout")
+            return
+
+        try:
+            self.ldap.wait(timeout)
+        except core.TimeoutExpired as e:
             self._send_empty(504, str(e))
         else:
             self._send_empty(204)
@@ -131,12 +236,23 @@ class ProxyServer(core.BaseServer):
     """A proxy to an LDAP server, based on its control API."""
     def __init__(self, url):
         self.base_url = url
+        # Reuse connections to the control server across calls.
+        self._session = requests.Session()
+        # A single host: a handful of connections is enough for concurrent callers.
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=4)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
         config = self._get_config()
         self.rootdn = config['rootdn']
         self.rootpw = config['rootpw']
         self.suffix = config['suffix']
         self.port = config['port']
         self.host = config['host']
+        # Exchange entries as msgpack only if both ends support it;
+        # older servers don't advertise it.
+        self._use_msgpack = msgpack is not None and config.get('msgpack', False)
+        # Not provided by older servers
+        self._uri = config.get('uri')
         if config['tls_root']:
             self.tls_config = core.TLSConfig(
                 root=config['tls_root'],
@@ -147,47 +263,77 @@ class ProxyServer(core.BaseServer):
         else:
             self.tls_config = None
 
+    @property
+    def uri(self):
+        return self._uri or super().uri
+
     def _path(self, path):
         return urljoin(self.base_url, path)
 
     def _get_config(self):
-        response = requests.get(self._path('config/'))
+        response = self._session.get(self._path('config/'))
         response.raise_for_status()
         return response.json()
 
     def reset(self):
-        response = requests.post(self._path('control/reset/'))
+        response = self._session.post(self._path('control/reset/'))
         response.raise_for_status()
 
     def get(self, dn):
-        response = requests.get(self._path('entry/') + dn)
+        headers = {'Accept': MSGPACK_CONTENT_TYPE} if self._use_msgpack else {}
+        response = self._session.get(self._path('entry/') + dn, headers=headers)
         if response.status_code == 404:
             raise KeyError(dn)
         response.raise_for_status()
+        if response.headers.get('Content-Type') == MSGPACK_CONTENT_TYPE:
+            return msgpack.unpackb(response.content, raw=False)
         entries = core.ldif_to_entries(response.content)
         assert len(entries) == 1
         return list(entries.values())[0]
 
     def add(self, data):
-        lines = '\n'.join(core.entries_to_ldif(data))
-        response = requests.post(self._path('entry/'), data=lines.encode('ascii'))
+        if self._use_msgpack:
+            response = self._session.post(
+                self._path('entry/'),
+                data=msgpack.packb(data, use_bin_type=True),
+                headers={'Content-Type': MSGPACK_CONTENT_TYPE},
+            )
+        else:
+            ldif = b'\n'.join(core.entries_to_ldif_bytes(data))
+            response = self._session.post(self._path('entry/'), data=ldif)
         response.raise_for_status()
 
     def start(self):
-        response = requests.post(self._path('control/start/'))
+        response = self._session.post(self._path('control/start/'))
         response.raise_for_status()
 
     def wait(self, timeout=None):
         since = time.time()
-        while timeout is None or time.time() - since < timeout:
-            response = requests.get(self._path('control/wait/'))
-            if response.status_code == 504:
-                continue
+        backoff = 0.05
+        while True:
+            if timeout is None:
+                remaining = DEFAULT_WAIT_TIMEOUT
             else:
+                remaining = timeout - (time.time() - since)
+                if remaining <= 0:
+                    raise core.TimeoutExpired('', timeout=timeout)
+
+            # The server blocks for up to `remaining` seconds.
+            response = self._session.get(
+                self._path('control/wait/'),
+                params={'timeout': remaining},
+                timeout=remaining + 5,
+            )
+            if response.status_code != 504:
                 response.raise_for_status()
                 return
-        raise core.TimeoutExpired('', timeout=timeout)
+
+            # Don't hammer servers answering before the timeout.
+            time.sleep(min(backoff, remaining))
+            backoff = min(backoff * 2, 1)
 
     def stop(self):
-        response = requests.post(self._path('control/stop/'))
+        response = self._session.post(self._path('control/stop/'))
         response.raise_for_status()
+        # Release idle connections; the session remains usable.
+        self._session.close()
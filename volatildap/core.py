@@ -96,9 +96,18 @@ class BaseServer:
         Returns:
             str: a LDIF file content.
         """
+        return '\n'.join(self.iter_ldif(dn))
+
+    def iter_ldif(self, dn):
+        """Fetch an item based on its DistinguisedName, as LDIF lines.
+
+        The entry is fetched immediately; a missing entry raises KeyError.
+
+        Returns:
+            iterator of str: the lines of a LDIF file, to be joined with '\n'.
+        """
         entry = self.get(dn)
-        lines = self._data_as_ldif({dn: entry})
-        return '\n'.join(lines)
+        return self._data_as_ldif({dn: entry})
 
     def _normalize_dn(self, dn):
         if not dn.endswith(self.suffix):
@@ -106,11 +115,14 @@ class BaseServer:
         else:
             return dn
 
-    def _data_as_ldif(self, data):
-        return entries_to_ldif({
+    def _normalize_entries(self, data):
+        return {
             self._normalize_dn(dn): attributes
             for dn, attributes in data.items()
-        })
+        }
+
+    def _data_as_ldif(self, data):
+        return entries_to_ldif(self._normalize_entries(data))
 
     @property
     def uri(self):
@@ -129,7 +141,18 @@ _BASE_LDIF_ASCII_CODES = [
     if chr(i) not in [' ', '<', ':']
 ]
 
-_BASE_LDIF = [chr(i) for i in _BASE_LDIF_ASCII_CODES]
+_BASE_LDIF_BYTES = bytes(_BASE_LDIF_ASCII_CODES)
+
+# The mandatory header of a LDIF file
+_LDIF_HEADER = ('version: 1', '')
+_LDIF_HEADER_BYTES = tuple(line.encode('ascii') for line in _LDIF_HEADER)
+_LDIF_VERSION_RE = re.compile(rb'^version: +1$')
+
+# Any line of a LDIF file, without its line feed
+_LDIF_RAW_LINE_RE = re.compile(rb'^.*$', re.MULTILINE)
+
+# A valid attribute description, e.g 'cn' or 'userCertificate;binary'
+_LDIF_ATTRIBUTE_RE = re.compile(rb'^[A-Za-z][\w;-]*$')
 
 
 def ldif_encode(attr, value):
@@ -147,21 +170,26 @@ def ldif_encode(attr, value):
         A 'key: value' or 'key:: b64value' text line.
     """
     if isinstance(value, bytes):
-        if all(c in _BASE_LDIF_ASCII_CODES for c in value):
-            return '%s: %s' % (attr, value.decode('ascii'))
-        else:
-            return '%s:: %s' % (attr, base64.b64encode(value).decode('ascii'))
-    elif any(c not in _BASE_LDIF for c in value):
-        return '%s:: %s' % (attr, base64.b64encode(value.encode('utf-8')).decode('ascii'))
+        raw = value
+    else:
+        try:
+            # Fails on the first non-ASCII char.
+            raw = value.encode('ascii')
+        except UnicodeEncodeError:
+            return '%s:: %s' % (attr, base64.b64encode(value.encode('utf-8')).decode('ascii'))
+
+    # Deleting all valid bytes leaves only those requiring base64.
+    if raw.translate(None, _BASE_LDIF_BYTES):
+        return '%s:: %s' % (attr, base64.b64encode(raw).decode('ascii'))
     else:
-        return '%s: %s' % (attr, value)
+        return '%s: %s' % (attr, raw.decode('ascii'))
 
 
 def ldif_to_entries(ldif_lines):
     """Convert a LDIF file to a dict of dn => attributes.
 
     Args:
-        ldif_lines: ASCII-encoded LDIF string
+        ldif_lines: bytes, the LDIF content
 
     Returns:
         dict(dn => dict(attribute => list(values))), where:
@@ -172,35 +200,61 @@ def ldif_to_entries(ldif_lines):
     Note: the object's DN is not included in the attributes.
     """
     entries = {}
-    for entry in ldif_lines.decode('ascii').split('\n\n'):
-        if not entry.strip():
-            continue
-        if entry.startswith('version:'):
-            if re.match('^version: +1$', entry.strip()):
-                continue
-            else:
-                raise ValueError("Invalid LDIF file - missing 'version: 1' header")
-
-        attributes = {}
-        for line in entry.split('\n'):
-            if not line.strip():
-                continue
-            m = re.match(r'(\w+)(:?): (.*)', line.strip())
-            if m is None:
-                raise ValueError("Invalid line in ldif output: %r" % line)
-
-            field, is_extended, value = m.groups()
-            if is_extended:
-                value = base64.b64decode(value.encode('ascii'))
-            else:
-                value = value.encode('ascii')
-            attributes.setdefault(field, []).append(value)
-        dns = attributes.pop('dn', [b''])
-        assert len(dns) == 1
-        entries[dns[0].decode('utf-8')] = attributes
+    # Lines of the current entry, each as a list of folded parts.
+    lines = []
+    for match in _LDIF_RAW_LINE_RE.finditer(ldif_lines):
+        line = match.group()
+        if line.endswith(b'\r'):
+            # CRLF line ending: strip it before unfolding.
+            line = line[:-1]
+        if line.startswith(b' ') and lines:
+            # Continuation of the previous line
+            lines[-1].append(line[1:])
+        elif line.strip():
+            lines.append([line])
+        elif lines:
+            # A blank line ends the entry
+            _add_ldif_entry(entries, lines)
+            lines = []
+
+    if lines:
+        _add_ldif_entry(entries, lines)
     return entries
 
 
+def _add_ldif_entry(entries, lines):
+    """Parse the lines of a LDIF entry, and add it to `entries`."""
+    lines = [b''.join(parts) for parts in lines]
+    if lines[0].startswith(b'version:'):
+        if _LDIF_VERSION_RE.match(lines[0].strip()):
+            lines = lines[1:]
+        else:
+            raise ValueError("Invalid LDIF file - missing 'version: 1' header")
+
+    attributes = {}
+    for line in lines:
+        # A 'attribute: value' or 'attribute:: b64value' line
+        field, sep, value = line.partition(b':')
+        # 'attribute:< url' values are not supported.
+        if not sep or not _LDIF_ATTRIBUTE_RE.match(field) or value.startswith(b'<'):
+            raise ValueError("Invalid line in ldif output: %r" % line)
+
+        is_extended = value.startswith(b':')
+        if is_extended:
+            value = value[1:]
+        value = value.lstrip(b' ').rstrip(b' \t\r')
+        if is_extended:
+            value = base64.b64decode(value)
+        attributes.setdefault(field.decode('ascii'), []).append(value)
+
+    if not attributes:
+        # Only a version header
+        return
+    dns = attributes.pop('dn', [b''])
+    assert len(dns) == 1
+    entries[dns[0].decode('utf-8')] = attributes
+
+
 def entries_to_ldif(entries):
     """Convert a dict of dn => attributes to a LDIF file.
 
@@ -213,12 +267,31 @@ def entries_to_ldif(entries):
     Yields:
         str: lines of the file
     """
-    yield 'version: 1'
-    yield ''
+    yield from _LDIF_HEADER
+    yield from _entries_ldif_lines(entries)
+
+
+def _entries_ldif_lines(entries):
+    """Generate the lines of a LDIF file, without its header."""
     # Sort by dn length, thus adding parents first.
-    for dn, attributes in sorted(entries.items(), key=lambda e: (len(e[0]), e)):
+    for dn, attributes in sorted(entries.items(), key=lambda e: (len(e[0]), e[0])):
         yield ldif_encode('dn', dn)
         for attribute, values in sorted(attributes.items()):
             for value in values:
                 yield ldif_encode(attribute, value)
         yield ''
+
+
+def entries_to_ldif_bytes(entries):
+    """Convert a dict of dn => attributes to a LDIF file, as bytes.
+
+    Args:
+        entries: see entries_to_ldif()
+
+    Returns:
+        list(bytes): lines of the file, to be joined with b'\n'.
+    """
+    lines = list(_LDIF_HEADER_BYTES)
+    # Generated lines are always ASCII.
+    lines.extend(line.encode('ascii') for line in _entries_ldif_lines(entries))
+    return lines
@@ -3,21 +3,29 @@
 
 """Temporary LDAP server based on OpenLdap for tests."""
 
-from __future__ import unicode_literals
-
-import codecs
+import functools
 import logging
 import os
-import random
+import secrets
+import selectors
 import socket
+import ssl
 import subprocess
 import sys
 import tempfile
 import time
+import urllib.parse
 
 from . import control
 from . import core
 
+try:
+    import ldap3
+    from ldap3 import SAFE_SYNC  # Thread-safe strategy, ldap3>=2.8
+    from ldap3.core.exceptions import LDAPException
+except ImportError:
+    ldap3 = None
+
 logger = logging.getLogger(__name__.split('.')[0])
 
 
@@ -28,9 +36,27 @@ DEFAULT_SCHEMAS = (
 )
 DEFAULT_STARTUP_DELAY = 15
 DEFAULT_SLAPD_DEBUG = 0
+# Grace period for slapd to exit on SIGTERM, before SIGKILL
+SHUTDOWN_TIMEOUT = 2
+
+# Size of the memory map of the database, in bytes; the file is sparse.
+MDB_MAXSIZE = 32 * 1024 * 1024
+
+# Size of the pipes to ldap* commands: large LDIF streams need fewer wake-ups.
+PIPE_SIZE = 1024 * 1024
+# fcntl.F_SETPIPE_SZ, only exposed from Python 3.10 on
+_F_SETPIPE_SZ = 1031
+
+
+# Escape backslashes and double quotes in slapd.conf values
+_CONF_ESCAPE = str.maketrans({'\\': '\\\\', '"': '\\"'})
+
 
+def _conf_quote(base, *args):
+    return base % tuple(str(arg).translate(_CONF_ESCAPE) for arg in args)
 
-class OpenLdapPaths(object):
+
+class OpenLdapPaths:
     """Collection of Openldap-related paths, distribution dependend."""
 
     def __init__(self):
@@ -41,6 +67,7 @@ class OpenLdapPaths(object):
         self.ldapdelete = self._find_file('ldapdelete', self._BINARY_DIRS)
         self.ldapsearch = self._find_file('ldapsearch', self._BINARY_DIRS)
         self.slaptest = self._find_file('slaptest', self._BINARY_DIRS)
+        self.slapadd = self._find_file('slapadd', self._BINARY_DIRS)
 
     def _find_file(self, needle, candidates):
         """Find the first directory containing a given candidate file."""
@@ -65,6 +92,12 @@ class OpenLdapPaths(object):
     ] + os.environ.get('PATH', '').split(':')
 
 
+@functools.lru_cache(maxsize=1)
+def default_paths():
+    """The OpenLdapPaths of the system; looked up once per process."""
+    return OpenLdapPaths()
+
+
 class LdapServer(core.BaseServer):
     _DATASUBDIR = 'ldif-data'
 
@@ -81,16 +114,27 @@ class LdapServer(core.BaseServer):
                  slapd_debug=DEFAULT_SLAPD_DEBUG,
                  tls_config=None,
                  control_address=(),
+                 use_ldapi=False,
                  ):
 
-        self.paths = OpenLdapPaths()
+        self.paths = default_paths()
         self.suffix = suffix
         self.rootdn = rootdn
         self.rootpw = rootpw or self._generate_password()
         self.schemas = list(self._locate_schemas(schemas, skip_missing_schemas))
         self.initial_data = initial_data or {}
         self.max_server_startup_delay = max_server_startup_delay
-        self.port = port or find_available_port()
+        self.use_ldapi = use_ldapi
+        if use_ldapi:
+            # Listen on a unix socket: no TCP port to pick, and no race for it.
+            self.port = None
+            self._ldapi_path = os.path.join(
+                _tempdir_root() or tempfile.gettempdir(),
+                'volatildap-%s.sock' % secrets.token_hex(8),
+            )
+        else:
+            self.port = port or find_available_port()
+            self._ldapi_path = None
         self.host = host
         self.slapd_debug = slapd_debug
         self.tls_config = tls_config
@@ -98,6 +142,13 @@ class LdapServer(core.BaseServer):
 
         self._tempdir = None
         self._process = None
+        # Connection arguments shared by all ldap* commands; set by _setup()
+        self._ldap_base_args = ()
+        # In-process client connection, if ldap3 is available
+        self._conn = None
+
+        if use_ldapi and tls_config:
+            raise ValueError("TLS is not available over a ldapi:// socket")
 
         if control_address:
             self.control = control.ControlServer(
@@ -105,12 +156,15 @@ class LdapServer(core.BaseServer):
                 ldap_server=self,
             )
 
+    @property
+    def uri(self):
+        if self.use_ldapi:
+            return 'ldapi://%s' % urllib.parse.quote(self._ldapi_path, safe='')
+        return super().uri
+
     def _generate_password(self):
-        chars = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
-        return ''.join(
-            random.choice(chars)
-            for _i in range(20)
-        )
+        # 20 URL-safe characters
+        return secrets.token_urlsafe(15)
 
     def _locate_schemas(self, schemas, skip_missing_schemas):
         """Locate all schemas (look in openldap store).
@@ -133,23 +187,26 @@ class LdapServer(core.BaseServer):
                 raise core.PathError("Unable to locate schema %s at %s" % (schema, schema_file))
 
     def _configuration_lines(self):
-        def quote(base, *args):
-            return base % tuple("%s" % arg.replace('\\', '\\\\').replace('"', '\\"') for arg in args)
-
         for schema in self.schemas:
-            yield quote('include %s', schema)
+            yield _conf_quote('include %s', schema)
 
         if self.tls_config:
-            yield quote('TLSCACertificateFile %s', self._tls_chain_path)
-            yield quote('TLSCertificateFile %s', self._tls_certificate_path)
-            yield quote('TLSCertificateKeyFile %s', self._tls_key_path)
-
-        yield quote('moduleload back_hdb')
-        yield quote('database hdb')
-        yield quote('directory %s', self._datadir)
-        yield quote('suffix %s', self.suffix)
-        yield quote('rootdn %s', self.rootdn)
-        yield quote('rootpw %s', self.rootpw)
+            yield _conf_quote('TLSCACertificateFile %s', self._tls_chain_path)
+            yield _conf_quote('TLSCertificateFile %s', self._tls_certificate_path)
+            yield _conf_quote('TLSCertificateKeyFile %s', self._tls_key_path)
+
+        yield _conf_quote('moduleload back_mdb')
+        yield _conf_quote('database mdb')
+        yield _conf_quote('maxsize %s', MDB_MAXSIZE)
+        yield _conf_quote('directory %s', self._datadir)
+        yield _conf_quote('suffix %s', self.suffix)
+        yield _conf_quote('rootdn %s', self.rootdn)
+        yield _conf_quote('rootpw %s', self.rootpw)
+
+        # objectClass is built into slapd; cn and uid come from core.schema.
+        yield _conf_quote('index objectClass eq,pres')
+        if any(os.path.basename(schema) == 'core.schema' for schema in self.schemas):
+            yield _conf_quote('index cn,uid eq,pres,sub')
 
     def start(self):
         logger.info("Starting LDAP server")
@@ -162,12 +219,24 @@ class LdapServer(core.BaseServer):
                 self._start()
             else:
                 self._clear()
-            self._populate()
+                self._populate()
         except Exception as e:
             logger.exception("Error starting LDAP server: %s", e)
             self._shutdown()
             raise
 
+    async def astart(self):
+        """Start the server from asyncio code.
+
+        The blocking start() runs in the loop's default executor: starting
+        several servers with asyncio.gather() overlaps their startup.
+        """
+        # Only needed here: keep it out of the import time of the module.
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.start)
+
     def wait(self, timeout=None):
         try:
             self._process.wait(timeout=timeout)
@@ -179,41 +248,66 @@ class LdapServer(core.BaseServer):
         self._shutdown()
 
     def add(self, data):
-        lines = '\n'.join(self._data_as_ldif(data))
-        ldif = lines.encode('utf-8')
+        if self._conn is not None:
+            self._add_entries(self._normalize_entries(data))
+            return
 
-        logger.info("Adding data %r", ldif)
-        sp = subprocess.Popen(
+        logger.info("Adding data %r", data)
+        sp = _popen(
             [
                 self.paths.ldapadd,
-                '-x',
-                '-D', self.rootdn,
-                '-w', self.rootpw,
-                '-H', self.uri,
+                *self._ldap_base_args,
             ],
             stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
+            # ldapadd reports each added entry: don't let that fill a pipe
+            # while we're still writing.
+            stdout=subprocess.DEVNULL,
             stderr=subprocess.PIPE,
             env=self._subprocess_env
         )
-        stdout, stderr = sp.communicate(ldif)
+        self._write_ldif(sp, data)
+        _stdout, stderr = sp.communicate()
         retcode = sp.wait()
         if retcode != 0:
-            raise RuntimeError("ldapadd failed with code %d: %s %s" % (retcode, stdout, stderr))
+            raise RuntimeError("ldapadd failed with code %d: %s" % (retcode, stderr))
 
     def add_ldif(self, lines):
         self.add(core.ldif_to_entries(lines))
 
+    def _write_ldif(self, sp, data):
+        """Stream entries as LDIF to the stdin of a subprocess.
+
+        The file is never built as a whole in memory; the pipe provides
+        backpressure. sp.communicate() flushes and closes stdin afterwards.
+        """
+        try:
+            for line in self._data_as_ldif(data):
+                # Generated lines are always ASCII.
+                sp.stdin.write(line.encode('ascii'))
+                sp.stdin.write(b'\n')
+        except BrokenPipeError:
+            # The command stopped early; its exit code and stderr tell why.
+            pass
+
+    def _add_entries(self, entries):
+        """Add entries through the ldap3 connection."""
+        logger.info("Adding entries %r", entries)
+        # Sort by dn length, thus adding parents first.
+        for dn, attributes in sorted(entries.items(), key=lambda e: (len(e[0]), e[0])):
+            status, result, _response, _request = self._conn.add(dn, attributes=attributes)
+            if not status:
+                raise RuntimeError("Adding %s failed with code %d: %s" % (dn, result['result'], result['description']))
+
     def get(self, dn):
         dn = self._normalize_dn(dn)
         logger.info("Fetching data at %s", dn)
-        sp = subprocess.Popen(
+        if self._conn is not None:
+            return self._get_entry(dn)
+
+        sp = _popen(
             [
                 self.paths.ldapsearch,
-                '-x',
-                '-D', self.rootdn,
-                '-w', self.rootpw,
-                '-H', self.uri,
+                *self._ldap_base_args,
                 '-LLL',  # As LDIF
                 '-b', dn,  # Fetch this specific DN
                 '-s', 'base',
@@ -233,10 +327,44 @@ class LdapServer(core.BaseServer):
         entries = core.ldif_to_entries(stdout)
         return entries[dn]
 
-    def get_ldif(self, dn):
-        entry = self.get(dn)
-        lines = self._data_as_ldif({dn: entry})
-        return '\n'.join(lines)
+    def _get_entry(self, dn):
+        """Fetch an entry through the ldap3 connection."""
+        status, result, response, _request = self._conn.search(
+            dn,
+            '(objectClass=*)',
+            search_scope=ldap3.BASE,
+            attributes=ldap3.ALL_ATTRIBUTES,
+        )
+        if result['result'] == 32:
+            # Not found
+            raise KeyError("Entry %s not found: %r" % (dn, result['message']))
+        if not status:
+            raise RuntimeError("Search failed with code %d: %s" % (result['result'], result['description']))
+
+        return {
+            attribute: list(values)
+            for attribute, values in response[0]['raw_attributes'].items()
+        }
+
+    def _delete_tree(self):
+        """Delete all entries through the ldap3 connection."""
+        status, result, response, _request = self._conn.search(
+            self.suffix,
+            '(objectClass=*)',
+            search_scope=ldap3.SUBTREE,
+            attributes=ldap3.NO_ATTRIBUTES,
+        )
+        if not status:
+            raise RuntimeError("Search failed with code %d: %s" % (result['result'], result['description']))
+
+        dns = [entry['dn'] for entry in response if entry['type'] == 'searchResEntry']
+        # Remove the furthest first
+        for dn in sorted(dns, key=lambda dn: (len(dn), dn), reverse=True):
+            status, result, _response, _request = self._conn.delete(dn)
+            if not status:
+                raise RuntimeError(
+                    "Deleting %s failed with code %d: %s" % (dn, result['result'], result['description'])
+                )
 
     def reset(self):
         """Reset all entries except inital ones."""
@@ -279,7 +407,13 @@ class LdapServer(core.BaseServer):
         }
 
     def _setup(self):
-        self._tempdir = tempfile.TemporaryDirectory()
+        self._tempdir = tempfile.TemporaryDirectory(dir=_tempdir_root())
+        self._ldap_base_args = (
+            '-x',
+            '-D', self.rootdn,
+            '-w', self.rootpw,
+            '-H', self.uri,
+        )
         logger.info("Setting up openldap server in %s", self._tempdir.name)
 
         # Create datadir
@@ -289,26 +423,53 @@ class LdapServer(core.BaseServer):
         if self.tls_config:
             chain = [cert.strip() for cert in self.tls_config.chain]
 
-            with codecs.open(self._tls_ca_bundle_path, 'w', encoding='utf-8') as f:
+            with open(self._tls_ca_bundle_path, 'w', encoding='utf-8') as f:
                 f.write(self.tls_config.root)
-            with codecs.open(self._tls_chain_path, 'w', encoding='utf-8') as f:
+            with open(self._tls_chain_path, 'w', encoding='utf-8') as f:
                 f.write('\n'.join(chain))
-            with codecs.open(self._tls_certificate_path, 'w', encoding='utf-8') as f:
+            with open(self._tls_certificate_path, 'w', encoding='utf-8') as f:
                 f.write(self.tls_config.certificate)
-            with codecs.open(self._tls_key_path, 'w', encoding='utf-8') as f:
+            with open(self._tls_key_path, 'w', encoding='utf-8') as f:
                 f.write(self.tls_config.key)
 
         # Write configuration
-        with codecs.open(self._slapd_conf, 'w', encoding='utf-8') as f:
+        with open(self._slapd_conf, 'w', encoding='utf-8') as f:
             f.write('\n'.join(self._configuration_lines()))
 
-        slaptest = subprocess.Popen([
-            self.paths.slaptest,
-            '-f', self._slapd_conf,
-            '-u',  # only test the config file
-        ])
+        slaptest = subprocess.Popen(
+            [
+                self.paths.slaptest,
+                '-f', self._slapd_conf,
+                '-u',  # only test the config file
+            ],
+            stdout=subprocess.DEVNULL,
+            # Only read on failure
+            stderr=subprocess.PIPE,
+        )
+        _stdout, stderr = slaptest.communicate()
         if slaptest.wait() != 0:
-            raise RuntimeError("Testing configuration failed.")
+            raise RuntimeError("Testing configuration failed: %r" % stderr)
+
+        self._load(self._initial_entries)
+
+    def _load(self, data):
+        """Load entries into the database of a *stopped* server."""
+        logger.info("Loading data %r", data)
+        sp = _popen(
+            [
+                self.paths.slapadd,
+                '-f', self._slapd_conf,
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            env=self._subprocess_env
+        )
+        self._write_ldif(sp, data)
+        _stdout, stderr = sp.communicate()
+        retcode = sp.wait()
+        if retcode != 0:
+            raise RuntimeError("slapadd failed with code %d: %s" % (retcode, stderr))
 
     def _start(self):
         """Start the server."""
@@ -325,51 +486,54 @@ class LdapServer(core.BaseServer):
             stderr=sys.stderr,
         )
         self._poll_slapd(timeout=self.max_server_startup_delay)
+        self._connect()
 
-    def _populate(self):
-        """Populate a *running* server with initial data."""
-        self.add(self._core_data)
-        if self.initial_data:
-            self.add(self.initial_data)
+    def _connect(self):
+        """Open an in-process connection to the server, if ldap3 is available.
 
-    def _clear(self):
-        logger.info("Preparing to clear all data")
-        sp = subprocess.Popen(
-            [
-                self.paths.ldapsearch,
-                '-x',
-                '-D', self.rootdn,
-                '-w', self.rootpw,
-                '-H', self.uri,
-                '-LLL',  # As LDIF
-                '-b', self.suffix,  # The whole tree
-                '-s', 'sub',  # All children
-                'dn',  # Fetch only the 'dn' field
-            ],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            env=self._subprocess_env
+        Otherwise, operations run through the ldapadd / ldapsearch commands.
+        """
+        if ldap3 is None:
+            return
+
+        tls = None
+        if self.tls_config:
+            tls = ldap3.Tls(ca_certs_file=self._tls_ca_bundle_path, validate=ssl.CERT_REQUIRED)
+        self._conn = ldap3.Connection(
+            ldap3.Server(self.uri, tls=tls, get_info=ldap3.NONE),
+            user=self.rootdn,
+            password=self.rootpw,
+            client_strategy=SAFE_SYNC,
+            auto_bind=True,
         )
-        stdout, stderr = sp.communicate()
-        retcode = sp.wait()
-        if retcode != 0:
-            raise RuntimeError("ldapsearch failed with code %d: %r" % (retcode, stderr))
 
-        data = core.ldif_to_entries(stdout)
-        dns = data.keys()
-        # Remove the furthest first
-        dns = sorted(dns, key=lambda dn: (len(dn), dn), reverse=True)
+    @property
+    def _initial_entries(self):
+        data = dict(self._core_data)
+        data.update(self.initial_data)
+        return data
+
+    def _populate(self):
+        """Populate a *running* server with initial data."""
+        # A single batch: entries are sorted so that parents come first.
+        self.add(self._initial_entries)
 
-        logger.info("Deleting entries %s", dns)
-        sp = subprocess.Popen(
+    def _clear(self):
+        logger.info("Clearing all data")
+        if self._conn is not None:
+            self._delete_tree()
+            return
+
+        # ldapdelete walks and deletes the whole tree by itself; OpenLDAP
+        # doesn't support the server-side "tree delete" control.
+        sp = _popen(
             [
                 self.paths.ldapdelete,
-                '-x',
-                '-D', self.rootdn,
-                '-w', self.rootpw,
-                '-H', self.uri,
-            ] + dns,
-            stdout=subprocess.PIPE,
+                *self._ldap_base_args,
+                '-r',  # Recursive
+                self.suffix,
+            ],
+            stdout=subprocess.DEVNULL,
             stderr=subprocess.PIPE,
             env=self._subprocess_env
         )
@@ -379,32 +543,79 @@ class LdapServer(core.BaseServer):
             raise RuntimeError("ldapdelete failed with code %d: %r" % (retcode, stderr))
 
     def _poll_slapd(self, timeout=DEFAULT_STARTUP_DELAY):
-        """Poll slapd port until available."""
+        """Poll slapd port until available.
 
-        begin = time.time()
-        time.sleep(0.5)
-        while time.time() < begin + timeout:
-            if self._process.poll() is not None:
-                raise RuntimeError("LDAP server has exited before starting listen.")
+        Between attempts, wait on the slapd process itself when the platform
+        allows it (pidfd_open, Linux >= 5.3): a crash is noticed at once.
+        """
+        pidfd = _pidfd_open(self._process.pid)
+        selector = None
+        if pidfd is not None:
+            selector = selectors.DefaultSelector()
+            selector.register(pidfd, selectors.EVENT_READ)
 
-            s = socket.socket()
-            try:
-                s.connect((self.host, self.port))
-            except socket.error:
-                # Not ready yet, sleep
-                time.sleep(0.5)
-            else:
-                return
-            finally:
-                s.close()
+        try:
+            begin = time.time()
+            # slapd usually starts within a few dozen milliseconds.
+            delay = 0.005
+            while time.time() < begin + timeout:
+                if self._process.poll() is not None:
+                    raise RuntimeError("LDAP server has exited before starting listen.")
+
+                try:
+                    s = self._probe_slapd()
+                except OSError:
+                    # Not ready yet: wait, unless slapd exits in the meantime.
+                    if selector is None:
+                        time.sleep(delay)
+                    else:
+                        selector.select(delay)
+                    delay = min(delay * 2, 0.1)
+                else:
+                    s.close()
+                    return
+        finally:
+            if selector is not None:
+                selector.close()
+                os.close(pidfd)
 
         raise RuntimeError("LDAP server not responding within %s seconds." % timeout)
 
+    def _probe_slapd(self):
+        """Open a connection to the slapd socket; raises OSError if not listening."""
+        if self.use_ldapi:
+            s = socket.socket(socket.AF_UNIX)
+            try:
+                s.settimeout(0.1)
+                s.connect(self._ldapi_path)
+            except OSError:
+                s.close()
+                raise
+            return s
+        return socket.create_connection((self.host, self.port), timeout=0.1)
+
     def _shutdown(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            try:
+                conn.unbind()
+            except LDAPException as e:
+                logger.warning("Error closing connection to LDAP server: %s", e)
         if self._process is not None:
             self._process.terminate()
-            self._process.wait()
+            try:
+                self._process.wait(timeout=SHUTDOWN_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                logger.warning("LDAP server didn't stop within %s seconds, killing it", SHUTDOWN_TIMEOUT)
+                self._process.kill()
+                self._process.wait()
             self._process = None
+        if self._ldapi_path is not None:
+            try:
+                os.unlink(self._ldapi_path)
+            except FileNotFoundError:
+                # Removed by slapd, or never created
+                pass
         if self._tempdir is not None:
             self._tempdir.cleanup()
             self._tempdir = None
@@ -431,6 +642,53 @@ class LdapServer(core.BaseServer):
         return '<%s at %s [%s]>' % (self.__class__.__name__, self.uri, state)
 
 
+def _tempdir_root():
+    """Pick a RAM-backed folder for the server files, if available.
+
+    The database is thrown away with the server: writing it to disk is wasted.
+    Returns None, i.e the tempfile default, when TMPDIR is set or no tmpfs is found.
+    """
+    if os.environ.get('TMPDIR'):
+        return None
+    for candidate in ('/dev/shm', '/run/user/%d' % os.getuid()):
+        if os.path.isdir(candidate) and os.access(candidate, os.W_OK | os.X_OK):
+            return candidate
+    return None
+
+
+def _pidfd_open(pid):
+    """Get a file descriptor becoming readable when a process exits.
+
+    Returns None when unsupported: not Linux >= 5.3, or Python < 3.9.
+    """
+    if not hasattr(os, 'pidfd_open'):
+        return None
+    try:
+        return os.pidfd_open(pid)
+    except OSError:
+        return None
+
+
+def _popen(args, **kwargs):
+    """Run a command through subprocess.Popen, with larger pipes on Linux.
+
+    Resizing is best-effort: the command runs with default pipes otherwise.
+    """
+    sp = subprocess.Popen(args, **kwargs)
+    if sys.platform.startswith('linux'):
+        import fcntl
+
+        for pipe in (sp.stdin, sp.stdout, sp.stderr):
+            if pipe is None:
+                continue
+            try:
+                fcntl.fcntl(pipe.fileno(), _F_SETPIPE_SZ, PIPE_SIZE)
+            except OSError:
+                # Above /proc/sys/fs/pipe-max-size, or over the user's quota
+                pass
+    return sp
+
+
 def find_available_port():
     """Find an available port.
 